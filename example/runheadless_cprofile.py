@@ -2,18 +2,33 @@
 Created on 30.05.2022
 
 @author: Sascha Holzhauer
+
+Usage: python -m cProfile -o profile01.out example/runheadless_cprofile.py [configfile]
+with configfile relative to example/config, e.g. resultdb_pool.cfg to profile the writer pool
 '''
 
 from example.model import ConwaysGameOfLife
+from mesa_dbdatacollection.dbdatacollection import DbDataCollector
 
 from sqlalchemy import event
 from sqlalchemy.engine import Engine
+import os
+import sys
 import time
 
     
 if __name__ == '__main__':
     
+    configfile = sys.argv[1] if len(sys.argv) > 1 else "resultdb.cfg"
     golmodel = ConwaysGameOfLife(width = 100, height=100, usedb=True)
+    datacollector = DbDataCollector(
+            configfile = os.path.dirname(os.path.abspath(__file__)) + "/config/" + configfile,
+            agent_reporters={"isAlive": "isAlive",
+                             "x": lambda a: a.x,
+                             "y": lambda a: a.y,
+                             },
+            )
     for i in range(0,10):
         golmodel.step()
-    
\ No newline at end of file
+        datacollector.collect(golmodel)
+    datacollector.close()
@@ -0,0 +1,97 @@
+'''
+Created on 19.10.2026
+
+- detects columns of low-cardinality string or enum values
+- replaces their values by integer codes and keeps the dictionary per column
+
+'''
+from enum import Enum
+
+import numpy as np
+import pandas as pd
+
+# suffix of the DB column that holds the codes of a categorical column
+CODE_SUFFIX = '_code'
+
+
+def _is_category(value):
+    '''
+    :param value: reporter value
+    :return: True if the value can be dictionary encoded
+    '''
+    return isinstance(value, (str, Enum))
+
+
+class CategoryEncoder():
+    '''
+    Dictionary encoding of categorical reporter values.
+
+    A column is classified with its first batch that has a non-missing value.
+    If all values are strings or enums and there are at most maxcardinality
+    distinct values, the column is encoded from then on. Missing values are
+    encoded as -1. If a later batch brings other values or more distinct values
+    than maxcardinality, the column is no longer encoded and its values are
+    returned as they are.
+    '''
+
+    def __init__(self, maxcardinality):
+        '''
+        Constructor
+
+        :param maxcardinality: maximum number of distinct values of a categorical column
+        '''
+        self.maxcardinality = maxcardinality
+        # column name -> {value: code}
+        self.codes = {}
+        # columns that are not encoded
+        self.raw = set()
+
+    def is_categorical(self, column):
+        '''
+        :param column: column name
+        :return: True if values of the column are encoded
+        '''
+        return column in self.codes
+
+    def encode(self, column, values):
+        '''
+        Encode values of a column.
+
+        :param column: column name
+        :param values: sequence of values
+        :return: tuple of the encoded values (the given values if the column is not
+                 categorical) and a list of (code, value) pairs that were added to
+                 the column's dictionary
+        '''
+        if column in self.raw:
+            return values, []
+
+        # a Series keeps tuple values as scalars
+        batchcodes, uniques = pd.factorize(pd.Series(list(values), dtype=object))
+
+        if column not in self.codes:
+            if len(uniques) == 0:
+                # no values to classify the column yet
+                return values, []
+            if len(uniques) > self.maxcardinality or not all(_is_category(v) for v in uniques):
+                self.raw.add(column)
+                return values, []
+            self.codes[column] = {}
+
+        mapping = self.codes[column]
+        new = [v for v in uniques if v not in mapping]
+        if len(mapping) + len(new) > self.maxcardinality or not all(_is_category(v) for v in new):
+            del self.codes[column]
+            self.raw.add(column)
+            return values, []
+
+        added = []
+        for v in new:
+            mapping[v] = len(mapping)
+            added.append((mapping[v], v.name if isinstance(v, Enum) else v))
+        # batch code -> column code, with -1 for missing values at the end
+        lookup = np.empty(len(uniques) + 1, dtype=np.int64)
+        lookup[-1] = -1
+        for i, v in enumerate(uniques):
+            lookup[i] = mapping[v]
+        return lookup[batchcodes], added
@@ -6,13 +6,18 @@ Created on 25.04.2022
 - reads DB config from given config file
 - creates tables and prepared statements as required during initialisation
 - adds rows to tables
+- spills batches to a local journal while the DB is unavailable and replays them later
+- optionally hands agent batches to a pool of writer processes
+- optionally stores categorical agent reporter values as integer codes
 
 '''
 from mesa.datacollection import DataCollector
 from functools import partial
 from operator import attrgetter
+from concurrent.futures import ThreadPoolExecutor, TimeoutError, wait
 import configparser
 import os
+import uuid
 #import time
 from datetime import datetime
 import pandas as pd
@@ -23,9 +28,11 @@ from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy import engine_from_config
 from sqlalchemy.ext.asyncio import create_async_engine
-from sqlalchemy import text, MetaData
+from sqlalchemy import text, MetaData, and_, inspect
 
-import d6tstack.utils
+from mesa_dbdatacollection.categories import CategoryEncoder, CODE_SUFFIX
+from mesa_dbdatacollection.spilljournal import SpillJournal
+from mesa_dbdatacollection.writerpool import WriterPool, write_df, unavailable_errors
 
 
 Base = declarative_base()
@@ -38,6 +45,14 @@ class RunInfo(Base):
     id = Column(Integer, primary_key=True)
     creation = Column(DateTime)
     
+class SpillBatch(Base):
+    '''
+    SpillBatch class to store IDs of journal batches that were replayed to the DB
+    '''
+    __tablename__ = 'spillbatches'
+    id = Column(String(32), primary_key=True)
+    replayed = Column(DateTime)
+    
 class DbDataCollector(DataCollector):
     '''
     classdocs
@@ -67,14 +82,42 @@ class DbDataCollector(DataCollector):
         
         self.configDb = dict(configParser.items('db'))
         self.cacheParams = dict(configParser.items('caching'))
+        self.spillParams = dict(configParser.items('spill')) if configParser.has_section('spill') else {}
         
         self.maxRunId = None
         
+        # batches are written to the journal instead of the DB once a write failed
+        self.spilling = False
+        self.journal = SpillJournal(self.spillParams['journal']) if 'journal' in self.spillParams else None
+        # with a timeout, DB writes run in a separate thread and a write that does not
+        # finish in time starts spilling
+        self.writethread = ThreadPoolExecutor(max_workers=1) \
+            if self.journal and 'timeout' in self.spillParams else None
+        # futures of writes that exceeded the timeout
+        self.stalled = []
+        
+        self.poolParams = dict(configParser.items('pool')) if configParser.has_section('pool') else {}
+        self.writerpool = WriterPool(int(self.poolParams['workers']), self.configDb,
+                                     int(self.poolParams.get('maxpending', 0))) \
+            if 'workers' in self.poolParams else None
+        # tables that exist in the DB and may be written by the writer pool
+        self.pooltables = set()
+        
+        self.categoryParams = dict(configParser.items('categorical')) \
+            if configParser.has_section('categorical') else {}
+        self.categories = CategoryEncoder(int(self.categoryParams['maxcardinality'])) \
+            if 'maxcardinality' in self.categoryParams else None
+        # table name -> names of columns known to exist in the DB
+        self.dbcolumns = {}
+        
         self.engine = engine_from_config(self.configDb)     
 
         self.meta = MetaData(bind=self.engine)
         self.meta.reflect()
         
+        if self.writethread:
+            SpillBatch.__table__.create(self.engine, checkfirst=True)
+        
         self.cachedrows = {}
         
         DBSession = sessionmaker(bind=self.engine)
@@ -112,8 +155,19 @@ class DbDataCollector(DataCollector):
         '''
         Close db session
         '''
+        if self.writerpool:
+            self._handle_failed_writes(self.writerpool.shutdown())
+            self.writerpool = None
+        if self.writethread:
+            # rows of stalled writes are in the journal, so do not wait for them forever
+            wait(self.stalled, timeout=float(self.spillParams['timeout']))
+            self.stalled = []
+            self.writethread.shutdown(wait=False)
+            self.writethread = None
         if self.session:
             self.session.close()
+        if self.journal:
+            self.journal.close()
                     
 
     def _new_table(self, table_name, table_columns):
@@ -163,7 +217,8 @@ class DbDataCollector(DataCollector):
         :type model. mesa.Model
         '''
 
-        self.addRunId()
+        if self.maxRunId is None:
+            self.addRunId()
             
         if self.model_reporters:
             self.model_vars = {}
@@ -192,15 +247,90 @@ class DbDataCollector(DataCollector):
             
         if self.agent_reporters:
             agent_records = self._record_agents(model)
-            
-            # store agents' records
-            df = pd.DataFrame(agent_records)
-            df.columns = ["runID", "step", "agentId"] + \
+            columnnames = ["runID", "step", "agentId"] + \
                     [func for func in self.agent_reporters.keys()]
+            columns = list(zip(*agent_records)) or [()] * len(columnnames)
             
-            self.pd_to_db(df, 'agents')
+            if self.categories:
+                self._encode_categories('agents', columnnames, columns, model.schedule.steps - 1)
+            
+            if self.writerpool:
+                self._handle_failed_writes(self.writerpool.harvest())
+            
+            submitted = False
+            if self.writerpool and not self.spilling and 'agents' in self.pooltables and columns[0]:
+                # leave dataframe conversion and writing to the writer pool;
+                # runID and step are the same for all rows
+                submitted = self.writerpool.submit('agents', dict(zip(columnnames[2:], columns[2:])),
+                                                   {'runID': columns[0][0], 'step': columns[1][0]})
+                if not submitted:
+                    # a worker process crashed; write synchronously from now on
+                    self._handle_failed_writes(self.writerpool.shutdown())
+                    self.writerpool = None
+            
+            if not submitted:
+                # store agents' records
+                df = pd.DataFrame(dict(zip(columnnames, columns)))
+                
+                self.pd_to_db(df, 'agents')
+                if not self.spilling:
+                    self.pooltables.add('agents')
 
     
+    def _encode_categories(self, tablename, columnnames, columns, step):
+        '''
+        Replace values of categorical reporter columns by integer codes (in place)
+        and store new dictionary entries to table categories.
+        Codes are stored in a column with CODE_SUFFIX appended to the reporter name,
+        so that a table never mixes values and codes in the same column. A column
+        that is no longer encoded is written to the column named after the reporter.
+        
+        :param tablename: table the columns are written to
+        :param columnnames: names of columns
+        :param columns: list of column value sequences, starting with runID, step and agentId
+        :param step: current step
+        '''
+        added = []
+        for i in range(3, len(columnnames)):
+            columns[i], codes = self.categories.encode(columnnames[i], columns[i])
+            added += [{'runID': self.maxRunId, 'step': step, 'tablename': tablename,
+                       'columnname': columnnames[i], 'code': code, 'value': value}
+                      for code, value in codes]
+            if self.categories.is_categorical(columnnames[i]):
+                columnnames[i] += CODE_SUFFIX
+        if added:
+            self.pd_to_db(pd.DataFrame(added), 'categories')
+        self._add_missing_columns(tablename, columnnames)
+        
+    def _add_missing_columns(self, tablename, columnnames):
+        '''
+        Add columns to an existing table, e.g. when a reporter column switches
+        between values and codes. Code columns are integers, others strings.
+        
+        :param tablename:
+        :param columnnames: names of columns to be written
+        '''
+        if set(columnnames) <= self.dbcolumns.get(tablename, set()):
+            return
+        try:
+            inspector = inspect(self.engine)
+            if not inspector.has_table(tablename):
+                # created with all columns by the first write
+                return
+            known = set(column['name'] for column in inspector.get_columns(tablename))
+            quote = self.engine.dialect.identifier_preparer.quote
+            with self.engine.begin() as con:
+                for name in columnnames:
+                    if name not in known:
+                        coltype = Integer() if name.endswith(CODE_SUFFIX) else String(255)
+                        con.execute(text("ALTER TABLE " + quote(tablename) + " ADD COLUMN " + quote(name) +
+                                         " " + coltype.compile(dialect=self.engine.dialect)))
+                        known.add(name)
+            self.dbcolumns[tablename] = known
+        except self._db_errors():
+            # the DB is unavailable; missing columns are added when spilled rows are replayed
+            pass
+    
     def add_table_row(self, table_name, row, ignore_missing=False):
         """
         Add a row dictionary to a specific table.
@@ -225,7 +355,9 @@ class DbDataCollector(DataCollector):
         self.cachedrows[table_name].append(d)
        
         if len(self.cachedrows[table_name]) % int(self.cacheParams['cachenum.tables']) == 0:
-            self.con.execute(self.tables[table_name].insert(), self.cachedrows[table_name])
+            rows = self.cachedrows[table_name]
+            self._write_or_spill(table_name, partial(pd.DataFrame, rows),
+                                 partial(self._insert_rows, self.tables[table_name], rows))
             self.cachedrows[table_name] = list()
 
     
@@ -250,22 +382,167 @@ class DbDataCollector(DataCollector):
         
     def pd_to_db(self, df, tablename):
         '''
-        Insert pandas dataframe to SQL DB using d6stack if DB URI is supported.
-        Otherwise use SQLalchemy.
+        Insert pandas dataframe to SQL DB.
+        If a spill journal is configured, the dataframe is appended to the journal
+        instead when the DB write fails or exceeds the configured timeout, and all
+        further writes go to the journal until replay_spill() is called.
+        
+        :param df:
+        :param tablename:
+        '''
+        self._write_or_spill(tablename, lambda: df, partial(self._write_df, df, tablename))
+        
+    def _insert_rows(self, table, rows, con=None):
+        '''
+        Insert row dictionaries into a table
+        
+        :param table: SQLalchemy table
+        :param rows: list of row dictionaries
+        :param con: connection to use (self.con if None)
+        '''
+        (con if con is not None else self.con).execute(table.insert(), rows)
+        
+    def _write_or_spill(self, tablename, get_df, write):
+        '''
+        Perform a DB write, or append its rows to the spill journal.
+        
+        With a timeout, the write runs in the write thread in a transaction that
+        also stores its batch ID in table spillbatches. If it does not finish in
+        time, its rows are journalled under the same batch ID right away, and
+        replay skips them in case the stalled write succeeds after all.
+        
+        :param tablename:
+        :param get_df: function returning the rows as pandas.DataFrame
+        :param write: function performing the DB write, given a connection or None
+        '''
+        if self.stalled:
+            self.stalled = [future for future in self.stalled if not future.done()]
+        if self.spilling:
+            self.journal.append(tablename, get_df())
+            return
+        
+        try:
+            if self.writethread:
+                batchid = uuid.uuid4().hex
+                future = self.writethread.submit(self._write_batch, batchid, write)
+                try:
+                    future.result(timeout=float(self.spillParams['timeout']))
+                except TimeoutError:
+                    self.stalled.append(future)
+                    self.spilling = True
+                    self.journal.append(tablename, get_df(), batchid)
+            else:
+                write(None)
+        except self._db_errors():
+            if not self.journal:
+                raise
+            self.spilling = True
+            self.journal.append(tablename, get_df())
+            
+    def _write_batch(self, batchid, write):
+        '''
+        Perform a DB write and store its batch ID in one transaction
+        
+        :param batchid: batch ID
+        :param write: function performing the DB write, given a connection
+        '''
+        with self.engine.begin() as con:
+            write(con)
+            con.execute(SpillBatch.__table__.insert(), {'id': batchid, 'replayed': datetime.now()})
+            
+    def _handle_failed_writes(self, failed):
+        '''
+        Spill batches the writer pool could not write to the DB
+        
+        :param failed: list of (table name, pandas.DataFrame, error message)
+        '''
+        for tablename, df, error in failed:
+            if not self.journal:
+                raise Exception("Could not write to table " + tablename + ": " + error)
+            self.spilling = True
+            self.journal.append(tablename, df)
+            
+    def flush(self):
+        '''
+        Wait until the writer pool has written all submitted batches
+        '''
+        if self.writerpool:
+            self._handle_failed_writes(self.writerpool.harvest(wait=True))
+            
+    def _db_errors(self):
+        '''
+        Exceptions that indicate a failed DB write because the DB is unavailable
+        '''
+        return unavailable_errors(self.engine)
+    
+    def _write_df(self, df, tablename, con=None):
+        '''
+        Insert pandas dataframe to SQL DB
         
         :param df:
         :param tablename:
+        :param con: connection with an open transaction to write in
         '''
-        if 'psycopg2' in self.configDb['sqlalchemy.url']:
-            d6tstack.utils.pd_to_psql(df, self.configDb['sqlalchemy.url'],
-            tablename, if_exists='append',sep=';')
+        write_df(df, tablename, self.configDb, self.engine, con)
             
-        elif 'mysql+mysqlconnector' in self.configDb['sqlalchemy.url']:
-            d6tstack.utils.pd_to_mysql(df, self.configDb['sqlalchemy.url'], tablename, if_exists='append',sep=';')
+    def get_db_table_dataframe(self, table_name, runId=None):
+        '''
+        Read rows of a run from a DB table. Code columns of categorical reporters
+        are replaced by the values from the dictionary stored in table categories.
+        
+        :param table_name: name of the table
+        :param runId: run ID (current run if None)
+        :return: pandas.DataFrame
+        '''
+        self.flush()
+        if runId is None:
+            runId = self.maxRunId
+        
+        self.meta.reflect()
+        if table_name not in self.meta.tables:
+            raise Exception("Table " + table_name + " does not exist.")
+        table = self.meta.tables[table_name]
+        df = pd.read_sql(table.select().where(table.c.runID == runId), self.engine)
+        
+        if 'categories' in self.meta.tables:
+            cattable = self.meta.tables['categories']
+            categories = pd.read_sql(cattable.select().where(and_(cattable.c.runID == runId,
+                                                                  cattable.c.tablename == table_name)),
+                                     self.engine)
+            for column, codes in categories.groupby('columnname'):
+                if column + CODE_SUFFIX in df.columns:
+                    values = df.pop(column + CODE_SUFFIX).map(
+                        dict(zip(codes['code'].astype(int), codes['value'])))
+                    # rows written after the column was no longer encoded hold their values
+                    if column in df.columns:
+                        values = df[column].where(df[column].notna(), values)
+                    df[column] = values
+        return df
             
-        elif 'mssql+pymssql' in self.configDb['sqlalchemy.url']:
-            d6tstack.utils.pd_to_mssql(df, self.configDb['sqlalchemy.url'], tablename, if_exists='append',sep=';')
+    def replay_spill(self):
+        '''
+        Bulk-load all batches from the spill journal into the DB and remove the journal.
+        Each batch is loaded in its own transaction, which also stores the batch ID
+        in table spillbatches; batches already stored there are skipped.
+        Replaying a journal again, e.g. after an interrupted replay, therefore
+        neither duplicates nor removes rows.
+        Afterwards, collected data is written to the DB again.
+        '''
+        if not self.journal:
+            return
         
-        else:
-            df.to_sql(tablename, self.engine, index= False, if_exists='append')
-            
\ No newline at end of file
+        self.flush()
+        
+        SpillBatch.__table__.create(self.engine, checkfirst=True)
+        spillbatches = SpillBatch.__table__
+        for batchid, tablename, df in self.journal.read():
+            if self.categories:
+                self._add_missing_columns(tablename, list(df.columns))
+            with self.engine.begin() as con:
+                if con.execute(spillbatches.select().where(spillbatches.c.id == batchid)).first():
+                    continue
+                self._write_df(df, tablename, con)
+                con.execute(spillbatches.insert(), {'id': batchid, 'replayed': datetime.now()})
+            
+        self.journal.clear()
+        self.spilling = False
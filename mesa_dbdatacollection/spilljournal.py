@@ -0,0 +1,93 @@
+'''
+Created on 19.10.2026
+
+- appends batches that could not be written to the DB to a local journal file
+- reads batches back from the journal for replay into the DB
+
+'''
+import os
+import pickle
+import struct
+import uuid
+
+# length prefix of each journal record
+_HEADER = struct.Struct('<Q')
+
+
+class SpillJournal():
+    '''
+    Append-only journal of (batch ID, table name, pandas.DataFrame) records.
+
+    Each record is a length-prefixed pickle, so that appending is cheap and a
+    record that was cut off by a crash is detected by its length and skipped.
+    The batch ID lets a replay recognise batches it has already loaded.
+    '''
+
+    def __init__(self, filename):
+        '''
+        Constructor
+
+        :param filename: path of the journal file
+        '''
+        self.filename = filename
+        self.file = None
+
+    def append(self, tablename, df, batchid=None):
+        '''
+        Append a batch to the journal.
+
+        :param tablename: name of the DB table the batch belongs to
+        :param df: batch of rows
+        :type df: pandas.DataFrame
+        :param batchid: batch ID (a new one if None)
+        :return: batch ID
+        '''
+        if self.file is None:
+            dirname = os.path.dirname(self.filename)
+            if dirname:
+                os.makedirs(dirname, exist_ok=True)
+            self.file = open(self.filename, 'ab')
+        if batchid is None:
+            batchid = uuid.uuid4().hex
+        payload = pickle.dumps((batchid, tablename, df), protocol=pickle.HIGHEST_PROTOCOL)
+        self.file.write(_HEADER.pack(len(payload)) + payload)
+        self.file.flush()
+        return batchid
+
+    def read(self):
+        '''
+        Iterate over all complete records in the journal.
+        A truncated trailing record is ignored.
+
+        :return: generator of (batch ID, table name, pandas.DataFrame) tuples
+        '''
+        if self.file:
+            self.file.flush()
+        if not os.path.exists(self.filename):
+            return
+        with open(self.filename, 'rb') as f:
+            while True:
+                header = f.read(_HEADER.size)
+                if len(header) < _HEADER.size:
+                    break
+                length, = _HEADER.unpack(header)
+                payload = f.read(length)
+                if len(payload) < length:
+                    break
+                yield pickle.loads(payload)
+
+    def clear(self):
+        '''
+        Close and remove the journal file
+        '''
+        self.close()
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+
+    def close(self):
+        '''
+        Close journal file
+        '''
+        if self.file:
+            self.file.close()
+            self.file = None
@@ -0,0 +1,276 @@
+'''
+Created on 19.10.2026
+
+- writes pandas dataframes to the DB with the fastest method supported for the DB URI
+- hands columnar batches via shared memory to worker processes that encode and write them
+
+'''
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+import io
+
+import numpy as np
+import pandas as pd
+
+from sqlalchemy import engine_from_config
+from sqlalchemy import exc
+
+import d6tstack.utils
+
+
+def unavailable_errors(engine):
+    '''
+    Exceptions that indicate that the DB is unavailable, as opposed to e.g.
+    programming errors or constraint violations
+
+    :param engine: SQLalchemy engine
+    :return: tuple of exception classes
+    '''
+    dbapi = engine.dialect.dbapi
+    return (exc.OperationalError, exc.InterfaceError, exc.DisconnectionError, exc.TimeoutError,
+            dbapi.OperationalError, dbapi.InterfaceError)
+
+def _copy_to_psql(df, tablename, con):
+    '''
+    Insert pandas dataframe to PostgreSQL with COPY in the transaction of the given connection.
+
+    :param df:
+    :param tablename:
+    :param con: SQLalchemy connection
+    '''
+    # create table if not existing
+    df.head(0).to_sql(tablename, con, index= False, if_exists='append')
+    buf = io.StringIO()
+    df.to_csv(buf, index=False, header=False, sep=';')
+    buf.seek(0)
+    quote = con.dialect.identifier_preparer.quote
+    columns = ', '.join(quote(str(column)) for column in df.columns)
+    con.connection.cursor().copy_expert("COPY " + quote(tablename) + " (" + columns +
+                                        ") FROM STDIN WITH (FORMAT csv, DELIMITER ';')", buf)
+
+def write_df(df, tablename, configDb, engine, con=None):
+    '''
+    Insert pandas dataframe to SQL DB using d6stack if DB URI is supported.
+    Otherwise use SQLalchemy.
+    If a connection is given, the rows are written in its transaction, using
+    COPY for PostgreSQL and SQLalchemy for other DBs.
+
+    :param df:
+    :param tablename:
+    :param configDb: db section of the config file
+    :param engine: SQLalchemy engine
+    :param con: SQLalchemy connection with an open transaction
+    '''
+    if con is not None:
+        if 'psycopg2' in configDb['sqlalchemy.url']:
+            _copy_to_psql(df, tablename, con)
+        else:
+            df.to_sql(tablename, con, index= False, if_exists='append')
+
+    elif 'psycopg2' in configDb['sqlalchemy.url']:
+        d6tstack.utils.pd_to_psql(df, configDb['sqlalchemy.url'],
+        tablename, if_exists='append',sep=';')
+
+    elif 'mysql+mysqlconnector' in configDb['sqlalchemy.url']:
+        d6tstack.utils.pd_to_mysql(df, configDb['sqlalchemy.url'], tablename, if_exists='append',sep=';')
+
+    elif 'mssql+pymssql' in configDb['sqlalchemy.url']:
+        d6tstack.utils.pd_to_mssql(df, configDb['sqlalchemy.url'], tablename, if_exists='append',sep=';')
+
+    else:
+        df.to_sql(tablename, engine, index= False, if_exists='append')
+
+
+# per worker process DB settings, set by _init_worker
+_configDb = None
+_engine = None
+
+def _init_worker(configDb):
+    '''
+    Create the worker process' own engine
+
+    :param configDb: db section of the config file
+    '''
+    global _configDb, _engine
+    _configDb = configDb
+    _engine = engine_from_config(configDb)
+
+def _to_frame(columns, blocks):
+    '''
+    Rebuild a dataframe from shared memory blocks, plain lists and constants.
+
+    :param columns: list of (column name, shared memory name, dtype, length) or
+                    (column name, None, None, values or constant)
+    :param blocks: dict of shared memory name to attached SharedMemory
+    :return: pandas.DataFrame
+    '''
+    data = {}
+    for name, shmname, dtype, values in columns:
+        if shmname is None:
+            data[name] = values
+        else:
+            data[name] = np.ndarray((values,), dtype=dtype, buffer=blocks[shmname].buf).copy()
+    return pd.DataFrame(data)
+
+def _write_columns(tablename, columns):
+    '''
+    Rebuild a dataframe from a submitted batch and write it to the DB.
+
+    :param tablename:
+    :param columns: see _to_frame()
+    :return: None on success, error message if the DB write failed
+    '''
+    blocks = {}
+    for _, shmname, _, _ in columns:
+        if shmname is not None:
+            blocks[shmname] = shared_memory.SharedMemory(name=shmname)
+    try:
+        df = _to_frame(columns, blocks)
+    finally:
+        for shm in blocks.values():
+            shm.close()
+    try:
+        write_df(df, tablename, _configDb, _engine)
+    except unavailable_errors(_engine) as e:
+        return repr(e)
+    return None
+
+
+def _numeric_array(values):
+    '''
+    :param values: sequence of values
+    :return: one-dimensional numeric numpy array of the values, or None if the
+             values are not all numbers (e.g. missing values, strings or tuples)
+    '''
+    try:
+        arr = np.asarray(values)
+    except ValueError:
+        # e.g. tuples of different lengths
+        return None
+    if arr.ndim != 1 or arr.dtype.kind not in 'biuf':
+        return None
+    return arr
+
+
+class WriterPool():
+    '''
+    Pool of worker processes that convert columnar batches to dataframes and
+    write them to the DB, so that the simulation process only extracts values.
+
+    Numeric columns are copied into shared memory blocks that are allocated once
+    per slot and reused; at most maxpending batches (one per slot) are in flight,
+    further submissions wait for the oldest batch. The dtype of a column is
+    determined per batch, so that e.g. integers followed by floats are kept
+    exactly; columns with missing or non-numeric values are pickled.
+    '''
+
+    def __init__(self, workers, configDb, maxpending=None):
+        '''
+        Constructor
+
+        :param workers: number of worker processes
+        :param configDb: db section of the config file
+        :param maxpending: maximum number of batches in flight (default: twice the workers)
+        '''
+        self.executor = ProcessPoolExecutor(max_workers=workers,
+                                            initializer=_init_worker, initargs=(configDb,))
+        self.maxpending = maxpending if maxpending else 2 * workers
+        # (future, table name, column descriptors, slot) of submitted batches
+        self.pending = []
+        # slots not in use; a slot is a dict of column name to SharedMemory
+        self.free = []
+        # (table name, pandas.DataFrame, error message) of failed batches
+        self.failed = []
+
+    def submit(self, tablename, columns, constants=None):
+        '''
+        Submit a columnar batch for writing.
+        Numeric columns are passed via shared memory, others are pickled.
+
+        :param tablename:
+        :param columns: dict of column name to sequence of values
+        :param constants: dict of column name to a value shared by all rows
+        :return: False if the pool is broken (e.g. a worker process crashed) and the
+                 batch was not submitted, True otherwise
+        '''
+        while len(self.pending) >= self.maxpending:
+            self._release(self.pending.pop(0))
+
+        slot = self.free.pop() if self.free else {}
+        try:
+            descriptors = [(name, None, None, value) for name, value in (constants or {}).items()]
+            for name, values in columns.items():
+                arr = _numeric_array(values)
+                if arr is None:
+                    descriptors.append((name, None, None, list(values)))
+                    continue
+
+                size = max(arr.nbytes, 1)
+                shm = slot.get(name)
+                if shm is None or shm.size < size:
+                    if shm is not None:
+                        del slot[name]
+                        shm.close()
+                        shm.unlink()
+                    shm = shared_memory.SharedMemory(create=True, size=size)
+                    slot[name] = shm
+                np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[:] = arr
+                descriptors.append((name, shm.name, arr.dtype.str, len(arr)))
+
+            future = self.executor.submit(_write_columns, tablename, descriptors)
+        except BrokenProcessPool:
+            self.free.append(slot)
+            return False
+        except Exception:
+            self.free.append(slot)
+            raise
+        self.pending.append((future, tablename, descriptors, slot))
+        return True
+
+    def _release(self, batch):
+        '''
+        Wait for a batch, keep its rows if writing failed and return its slot.
+
+        :param batch: entry of pending
+        '''
+        future, tablename, descriptors, slot = batch
+        try:
+            error = future.result()
+        except Exception as e:
+            error = repr(e)
+        if error:
+            blocks = dict((shm.name, shm) for shm in slot.values())
+            self.failed.append((tablename, _to_frame(descriptors, blocks), error))
+        self.free.append(slot)
+
+    def harvest(self, wait=False):
+        '''
+        Release resources of finished batches.
+
+        :param wait: if True, wait for all submitted batches
+        :return: list of (table name, pandas.DataFrame, error message) of batches
+                 whose write failed
+        '''
+        done = [batch for batch in self.pending if wait or batch[0].done()]
+        self.pending = [batch for batch in self.pending if batch not in done]
+        for batch in done:
+            self._release(batch)
+        failed, self.failed = self.failed, []
+        return failed
+
+    def shutdown(self):
+        '''
+        Wait for all submitted batches, stop the worker processes and
+        free shared memory
+
+        :return: see harvest()
+        '''
+        failed = self.harvest(wait=True)
+        self.executor.shutdown()
+        for slot in self.free:
+            for shm in slot.values():
+                shm.close()
+                shm.unlink()
+        self.free = []
+        return failed
@@ -4,6 +4,7 @@ Created on 07.07.2022
 @author: Sascha Holzhauer
 '''
 from example.model import ConwaysGameOfLife
+from mesa_dbdatacollection.dbdatacollection import DbDataCollector
 import os
 
 def run_model_dataframe():
@@ -36,5 +37,28 @@ def test_dataframe(benchmark):
 def test_db(benchmark):
     # benchmark something
     result = benchmark(run_model_db)
-    assert result == True   
-    
\ No newline at end of file
+    assert result == True
+
+def run_model_collect(configfile):
+    golmodel = ConwaysGameOfLife(width = 100, height=100)
+    datacollector = DbDataCollector(
+            configfile = os.path.dirname(os.path.abspath(__file__)) + "/config/" + configfile,
+            agent_reporters={"isAlive": "isAlive",
+                             "x": lambda a: a.x,
+                             "y": lambda a: a.y,
+                             },
+            )
+    for i in range(0,10):
+        golmodel.step()
+        datacollector.collect(golmodel)
+    datacollector.close()
+    
+    return True
+
+def test_db_collect(benchmark):
+    result = benchmark(run_model_collect, "resultdb.cfg")
+    assert result == True
+
+def test_db_collect_pool(benchmark):
+    result = benchmark(run_model_collect, "resultdb_pool.cfg")
+    assert result == True
@@ -6,10 +6,15 @@ Created on 08.07.2022
 
 import pytest
 from mesa_dbdatacollection.dbdatacollection import DbDataCollector, RunInfo
+from mesa_dbdatacollection.categories import CategoryEncoder
 from sqlalchemy import Column, Integer, MetaData
 
 import os
 import configparser
+import sqlite3
+import threading
+import pandas as pd
+from concurrent.futures import wait
 
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy import create_engine
@@ -154,4 +159,270 @@ class TestTableReporters:
             self.datacollector.add_table_row("testdata", row, ignore_missing=True)
         result = session.execute('SELECT COUNT(*)  AS numrows FROM testdata')
         assert result.fetchone()['numrows'] == model.grid.width * model.grid.height
-        
\ No newline at end of file
+        
+
+class TestSpillJournal:
+    """
+    Test spilling to the local journal while the DB is unavailable or stalls, and replay
+    """
+
+    datacollector = None
+    
+    @pytest.fixture()
+    def setupdb(self): 
+        self.datacollector = DbDataCollector(
+                configfile = os.path.dirname(os.path.abspath(__file__)) + "/config/resultdb_spill.cfg",
+                agent_reporters={"isAlive": "isAlive",
+                                 "x": lambda a: a.x,
+                                 },
+                tables={"testdata": [
+                    Column("runID", Integer),
+                    Column("Step", Integer),
+                    Column("unique_id", Integer),
+                    Column("alive_neighbors", Integer)
+                    ]}
+                )
+        yield
+        self.datacollector.journal.clear()
+        self.datacollector.close()
+        
+    def count_agents(self):
+        with self.datacollector.engine.connect() as con:
+            result = con.execute('SELECT COUNT(*)  AS numrows FROM agents WHERE `runID` = ' +
+                                 str(self.datacollector.maxRunId))
+            return result.fetchone()['numrows']
+        
+    def lock_db(self):
+        lock = sqlite3.connect(self.datacollector.engine.url.database,
+                               isolation_level=None, check_same_thread=False)
+        lock.execute('BEGIN EXCLUSIVE')
+        return lock
+
+    def test_spillAndReplay(self, setupdb):
+        model = setupmodel()
+        numagents = model.grid.width * model.grid.height
+        
+        # first step reaches the DB
+        model.step()
+        self.datacollector.collect(model)
+        assert not self.datacollector.spilling
+        
+        # stopped DB stand-in
+        engine = self.datacollector.engine
+        self.datacollector.engine = create_engine("sqlite+pysqlite:////nonexistent/sqlite.db")
+        model.step()
+        self.datacollector.collect(model)
+        assert self.datacollector.spilling
+        self.datacollector.engine = engine
+        
+        journalfile = self.datacollector.journal.filename
+        with open(journalfile, 'rb') as f:
+            journal = f.read()
+        
+        self.datacollector.replay_spill()
+        assert not self.datacollector.spilling
+        assert self.count_agents() == 2 * numagents
+        
+        # replaying the same journal again neither duplicates nor removes rows
+        with open(journalfile, 'wb') as f:
+            f.write(journal)
+        self.datacollector.replay_spill()
+        assert self.count_agents() == 2 * numagents
+        
+    def test_stalledWriteFails(self, setupdb):
+        model = setupmodel()
+        numagents = model.grid.width * model.grid.height
+        model.step()
+        self.datacollector.collect(model)
+        
+        # the write waits for the lock longer than the spill timeout, then fails
+        lock = self.lock_db()
+        model.step()
+        self.datacollector.collect(model)
+        assert self.datacollector.spilling
+        assert len(list(self.datacollector.journal.read())) == 1
+        wait(self.datacollector.stalled)
+        lock.execute('ROLLBACK')
+        lock.close()
+        
+        self.datacollector.replay_spill()
+        assert self.count_agents() == 2 * numagents
+        
+    def test_stalledWriteSucceeds(self, setupdb):
+        model = setupmodel()
+        numagents = model.grid.width * model.grid.height
+        model.step()
+        self.datacollector.collect(model)
+        
+        # the lock is released after the spill timeout, so the stalled write succeeds
+        lock = self.lock_db()
+        threading.Timer(2, lock.execute, ['ROLLBACK']).start()
+        model.step()
+        self.datacollector.collect(model)
+        assert self.datacollector.spilling
+        wait(self.datacollector.stalled)
+        lock.close()
+        
+        # replay skips the journalled batch
+        self.datacollector.replay_spill()
+        assert self.count_agents() == 2 * numagents
+        
+    def test_tableRows(self, setupdb):
+        model = setupmodel()
+        model.step()
+        self.datacollector.collect(model)
+        for row in model.neighbours:
+            self.datacollector.add_table_row("testdata", row, ignore_missing=True)
+        assert not self.datacollector.spilling
+        with self.datacollector.engine.connect() as con:
+            result = con.execute('SELECT COUNT(*)  AS numrows FROM testdata WHERE `runID` = ' +
+                                 str(self.datacollector.maxRunId))
+            assert result.fetchone()['numrows'] == model.grid.width * model.grid.height
+        
+    def test_truncatedJournal(self, setupdb):
+        journal = self.datacollector.journal
+        journal.append('agents', pd.DataFrame({'runID': [1], 'step': [0]}))
+        journal.append('agents', pd.DataFrame({'runID': [1], 'step': [1]}))
+        journal.close()
+        size = os.path.getsize(journal.filename)
+        with open(journal.filename, 'r+b') as f:
+            f.truncate(size - 5)
+        assert [df['step'][0] for _, _, df in journal.read()] == [0]
+
+
+class TestWriterPool:
+    """
+    Test writing agent reporters via the writer pool
+    """
+
+    datacollector = None
+    
+    @pytest.fixture()
+    def setupdb(self): 
+        # the value reporter changes its type between steps, so start with a new agents table
+        with create_engine("sqlite+pysqlite:///./tests/temp/sqlite_pool.db").begin() as con:
+            con.execute('DROP TABLE IF EXISTS agents')
+        self.datacollector = DbDataCollector(
+                configfile = os.path.dirname(os.path.abspath(__file__)) + "/config/resultdb_pool.cfg",
+                agent_reporters={"isAlive": "isAlive",
+                                 "x": lambda a: a.x,
+                                 "y": lambda a: a.y,
+                                 # int, int, float and partly missing values in steps 0 to 3
+                                 "value": lambda a: [a.x, a.x, a.x + 0.5, None if a.x % 2 else a.x]
+                                                    [(a.model.schedule.steps - 1) % 4],
+                                 },
+                )
+        yield
+        self.datacollector.close()
+        
+    def read_agents(self):
+        with self.datacollector.engine.connect() as con:
+            return pd.read_sql('SELECT * FROM agents WHERE `runID` = ' +
+                               str(self.datacollector.maxRunId), con)
+
+    def test_pooledAgentReporter(self, setupdb):
+        model = setupmodel()
+        for i in range(0,3):
+            model.step()
+            self.datacollector.collect(model)
+        self.datacollector.flush()
+        assert len(self.read_agents()) == 3 * model.grid.width * model.grid.height
+        
+    def test_changingTypes(self, setupdb):
+        model = setupmodel()
+        for i in range(0,4):
+            model.step()
+            self.datacollector.collect(model)
+        self.datacollector.flush()
+        agents = self.read_agents()
+        assert len(agents) == 4 * model.grid.width * model.grid.height
+        
+        floats = agents[agents['step'] == 2]
+        assert ((floats['value'] - floats['x']) == 0.5).all()
+        missing = agents[agents['step'] == 3]
+        assert missing[missing['x'] % 2 == 1]['value'].isna().all()
+        assert (missing[missing['x'] % 2 == 0]['value'] == missing[missing['x'] % 2 == 0]['x']).all()
+
+
+class TestCategoricalReporters:
+    """
+    Test integer encoding of categorical agent reporters
+    """
+
+    datacollector = None
+    
+    @pytest.fixture()
+    def setupdb(self): 
+        self.datacollector = DbDataCollector(
+                configfile = os.path.dirname(os.path.abspath(__file__)) + "/config/resultdb_categorical.cfg",
+                agent_reporters={"state": lambda a: "ALIVE" if a.isAlive else "DEAD",
+                                 # few values in step 0, one per agent afterwards
+                                 "label": lambda a: "first" if a.model.schedule.steps == 1
+                                                    else str(a.unique_id),
+                                 "x": lambda a: a.x,
+                                 },
+                )
+        yield
+        self.datacollector.close()
+
+    def test_categoricalReporter(self, setupdb):
+        model = setupmodel()
+        model.step()
+        self.datacollector.collect(model)
+        assert self.datacollector.categories.is_categorical("state")
+        assert not self.datacollector.categories.is_categorical("x")
+        
+        # codes are assigned in order of first appearance
+        states = ["ALIVE" if a.isAlive else "DEAD" for a in model.schedule.agents]
+        expected = dict(enumerate(dict.fromkeys(states)))
+        
+        runId = self.datacollector.maxRunId
+        with self.datacollector.engine.connect() as con:
+            categories = pd.read_sql('SELECT * FROM categories WHERE `runID` = ' + str(runId) +
+                                     ' AND `columnname` = \'state\'', con)
+            agents = pd.read_sql('SELECT * FROM agents WHERE `runID` = ' + str(runId), con)
+        assert dict(zip(categories['code'], categories['value'])) == expected
+        assert [expected[code] for code in agents['state_code']] == states
+        
+        df = self.datacollector.get_db_table_dataframe("agents")
+        assert len(df) == model.grid.width * model.grid.height
+        assert list(df["state"]) == states
+        
+    def test_exceedingCardinality(self, setupdb):
+        model = setupmodel()
+        for i in range(0,2):
+            model.step()
+            self.datacollector.collect(model)
+        assert not self.datacollector.categories.is_categorical("label")
+        
+        df = self.datacollector.get_db_table_dataframe("agents")
+        assert (df[df['step'] == 0]['label'] == "first").all()
+        steponerows = df[df['step'] == 1]
+        assert list(steponerows['label']) == [str(agentId) for agentId in steponerows['agentId']]
+        
+    def test_encoder(self):
+        encoder = CategoryEncoder(2)
+        values, added = encoder.encode("id", ["a", "b", "c"])
+        assert not encoder.is_categorical("id")
+        assert added == []
+        
+        # missing values only do not classify a column
+        encoder.encode("energy", [None, None])
+        assert not encoder.is_categorical("energy")
+        values, added = encoder.encode("energy", [None, 1.5])
+        assert not encoder.is_categorical("energy")
+        assert list(values) == [None, 1.5]
+        
+        values, added = encoder.encode("pos", [(0, 1), (1, 1)])
+        assert not encoder.is_categorical("pos")
+        assert list(values) == [(0, 1), (1, 1)]
+        
+        codes, added = encoder.encode("state", ["A", None, "B", "A"])
+        assert list(codes) == [0, -1, 1, 0]
+        assert added == [(0, "A"), (1, "B")]
+        
+        # exceeding the cardinality falls back to the values
+        values, added = encoder.encode("state", ["C", "A"])
+        assert not encoder.is_categorical("state")
+        assert list(values) == ["C", "A"]
+        assert added == []